@@ -1,87 +1,208 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
 import csv
 import hashlib
-import json
+from itertools import islice
 import sqlite3
 from lxml import etree
-from llama import analyze_sms
+import orjson
+from llama import analyze_sms_batch, template_stats
 import typer
 from loguru import logger
-import datetime
-from tqdm import tqdm
-from typing import Dict, List, Optional
+import time
+from tqdm.asyncio import tqdm
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
 app = typer.Typer()
 
+# Newlines become spaces; quotation marks are deleted in the same pass
+_CLEAN_TABLE = bytes.maketrans(b'\n', b' ')
+_CLEAN_DELETE = b'"\''
+
 def remove_newlines_non_ascii(text: str) -> str:
     """Clean text by removing newlines and non-ASCII characters."""
     # also remove any non-printable characters, quotation marks, and other special characters
-    return text.replace('\n', ' ').encode('ascii', 'ignore').decode('ascii').replace('"', '').replace("'", '')
+    return text.encode('ascii', 'ignore').translate(_CLEAN_TABLE, _CLEAN_DELETE).decode('ascii')
 
 def json_to_string(json_obj: Dict) -> str:
     """Convert JSON object to string."""
-    return json.dumps(json_obj)
+    return orjson.dumps(json_obj).decode()
 
-def floatify(value: str) -> float:
-    """Convert string to float."""
-    try:
+def floatify(value: Any) -> float:
+    """Convert LLM amount to float, or 0.0 if it isn't a plain number."""
+    # orjson already returns numeric JSON values as int/float
+    if isinstance(value, (int, float)):
         return float(value)
-    except ValueError:
-        return 0.0
+    # Pre-check instead of raising ValueError for every reply like "Not expense"
+    text = str(value).strip()
+    digits = text[1:] if text[:1] in ('-', '+') else text
+    if digits.replace('.', '', 1).isdecimal():
+        return float(text)
+    return 0.0
 
-def parse_sms_xml(xml_file: str) -> List[Dict]:
-    """Parse XML file containing SMS data with improved error handling."""
-    try:
-        with open(xml_file, 'r', encoding='utf-8') as file:
-            xml_string = file.read()
-        
-        root = etree.fromstring(xml_string.encode('utf-8'))
-        sms_list = []
+def body_hash(body: Optional[str]) -> Optional[str]:
+    """Dedupe key for a cleaned message body (stored in the historical body_md5 column)."""
+    if body is None:
+        return None
+    # Opaque 128-bit digest; blake2b is faster than the md5 used by older databases
+    return hashlib.blake2b(body.encode('utf-8'), digest_size=16).hexdigest()
+
+def preprocess_sms(sms_dict: Dict) -> Optional[Dict]:
+    """Clean, hash and normalize one SMS attribute dict; None if it has no body."""
+    # Messages without text can't be analyzed; skip them before any other work
+    body = remove_newlines_non_ascii(sms_dict.get('body', ''))
+    if not body:
+        return None
+    sms_dict['body'] = body
+    sms_dict['body_md5'] = body_hash(body)
+    
+    # Convert timestamp
+    if 'date' in sms_dict:
+        try:
+            timestamp = int(sms_dict['date'])
+            # time.strftime on a struct_time skips building a datetime object
+            sms_dict['date'] = time.strftime(
+                '%Y-%m-%d %H:%M:%S', time.localtime(timestamp // 1000)
+            )
+        except (ValueError, TypeError):
+            logger.warning(f"Invalid date format: {sms_dict.get('date')}")
+            sms_dict['date'] = None
+    
+    # Clean and normalize phone numbers
+    if 'address' in sms_dict:
+        sms_dict['address'] = str(sms_dict['address']).strip()
+    
+    return sms_dict
+
+def iter_sms_attributes(xml_file: str) -> Iterator[Dict]:
+    """Stream the raw attributes of every <sms> element in an XML backup file."""
+    # iterparse keeps memory flat regardless of backup size; tag='sms' is matched
+    # by lxml's C-level tag filter, so no XPath evaluation is involved
+    context = etree.iterparse(xml_file, events=('end',), tag='sms')
+    
+    for _, sms in context:
+        sms_dict = dict(sms.attrib)
         
-        for sms in root.xpath('//sms'):
-            sms_dict = dict(sms.attrib)
-            
-            # Convert timestamp
-            if 'date' in sms_dict:
-                try:
-                    timestamp = int(sms_dict['date'])
-                    sms_dict['date'] = datetime.datetime.fromtimestamp(
-                        timestamp / 1000
-                    ).strftime('%Y-%m-%d %H:%M:%S')
-                except (ValueError, TypeError):
-                    logger.warning(f"Invalid date format: {sms_dict.get('date')}")
-                    sms_dict['date'] = None
-            
-            # Clean and normalize phone numbers
-            if 'address' in sms_dict:
-                sms_dict['address'] = str(sms_dict['address']).strip()
-            
-            # Clean message body
-            if 'body' in sms_dict:
-                sms_dict['body'] = remove_newlines_non_ascii(sms_dict['body'])
-                sms_dict['body_md5'] = hashlib.md5(
-                    sms_dict['body'].encode()
-                ).hexdigest()
-            
-            sms_list.append(sms_dict)
+        # Free the element and any already-processed siblings
+        sms.clear()
+        while sms.getprevious() is not None:
+            del sms.getparent()[0]
         
-        return sms_list
+        yield sms_dict
+
+def parse_sms_xml(xml_file: str, workers: int = 1, chunksize: int = 256) -> Iterator[Dict]:
+    """Stream preprocessed SMS records with a non-empty body from an XML backup file.
+
+    With `workers` > 1, preprocessing runs in a process pool fed `chunksize * workers`
+    messages at a time, so memory stays bounded and analysis can start before the
+    whole file is read. Waiting on each window blocks the caller's event loop, so LLM
+    replies are only handled between windows; the pool only pays off when
+    preprocessing, not the LLM, is the bottleneck.
+    """
+    try:
+        attributes = iter_sms_attributes(xml_file)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                # Executor.map submits its whole input at once, so hand it bounded windows
+                while window := list(islice(attributes, chunksize * workers)):
+                    yield from filter(None, executor.map(preprocess_sms, window, chunksize=chunksize))
+        else:
+            yield from filter(None, map(preprocess_sms, attributes))
     
     except Exception as e:
         logger.error(f"Error parsing XML file: {e}")
         raise
 
-def analyze_sms_list(sms_list: List[Dict]) -> List[Dict]:
-    """Analyze SMS messages with improved data handling and validation."""
+def get_cached_analysis(conn: sqlite3.Connection, body_md5: str) -> Optional[Tuple[str, Optional[Dict]]]:
+    """Look up a previous LLM analysis for the given message body hash."""
+    row = conn.execute(
+        'SELECT llm_output, json_output FROM llm_cache WHERE body_md5 = ?', (body_md5,)
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0], orjson.loads(row[1])
+
+def cache_analysis(conn: sqlite3.Connection, body_md5: str, content: str, json_analysis: Optional[Dict]):
+    """Store an LLM analysis so identical message bodies are not sent to the LLM again."""
+    conn.execute(
+        'INSERT OR REPLACE INTO llm_cache (body_md5, llm_output, json_output) VALUES (?, ?, ?)',
+        (body_md5, content, json_to_string(json_analysis))
+    )
+
+async def analyze_sms_list_async(
+    sms_list: Iterable[Dict],
+    concurrency: int = 8,
+    conn: Optional[sqlite3.Connection] = None,
+    batch_size: int = 8
+) -> List[Dict]:
+    """Analyze SMS messages in batches of `batch_size`, keeping at most `concurrency` LLM requests in flight.
+
+    `sms_list` is consumed incrementally: each batch is sent to the LLM as soon as it
+    fills, while the rest of the input is still being read. The message records
+    themselves are kept until the end to build the output list.
+
+    If `conn` is given, results are cached in its `llm_cache` table by body hash.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    analyses: Dict[str, Tuple[str, Optional[Dict]]] = {}
+    # Each distinct uncached body is sent to the LLM once
+    to_analyze: Dict[str, str] = {}
+    messages: List[Dict] = []
+    tasks: List[asyncio.Task] = []
+    progress = tqdm(total=0, desc="Analyzing SMS", unit="batch")
+
+    async def analyze_batch(batch: List[str]):
+        # The semaphore is taken per Ollama request, including per-message fallbacks
+        results = await analyze_sms_batch([to_analyze[body_md5] for body_md5 in batch], semaphore)
+        for body_md5, (content, json_analysis) in zip(batch, results):
+            analyses[body_md5] = (content, json_analysis)
+            # Only cache parsed replies; a failed call or unparseable reply is retried next run
+            if conn is not None and json_analysis is not None:
+                cache_analysis(conn, body_md5, content, json_analysis)
+        progress.update(1)
+
+    def schedule(batch: List[str]):
+        progress.total += 1
+        progress.refresh()
+        tasks.append(asyncio.create_task(analyze_batch(batch)))
+
+    try:
+        batch: List[str] = []
+        for sms in sms_list:
+            messages.append(sms)
+            body_md5 = sms['body_md5']
+            if body_md5 in analyses or body_md5 in to_analyze:
+                continue
+            cached = get_cached_analysis(conn, body_md5) if conn is not None else None
+            if cached is not None:
+                analyses[body_md5] = cached
+                continue
+            to_analyze[body_md5] = sms['body']
+            batch.append(body_md5)
+            if len(batch) == batch_size:
+                schedule(batch)
+                batch = []
+                # Let scheduled batches make progress between reads
+                await asyncio.sleep(0)
+        if batch:
+            schedule(batch)
+        
+        logger.info(f"Read {len(messages)} SMS messages, {len(to_analyze)} need LLM analysis")
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    finally:
+        progress.close()
+        if conn is not None:
+            conn.commit()
+    
     output = []
-    for sms in tqdm(sms_list, desc="Analyzing SMS"):
-        if not sms.get('body'):
-            continue
-            
-        # Analyze message content
+    for sms in messages:
         try:
-            content, json_analysis = analyze_sms(sms['body'])
-        
-        
+            content, json_analysis = analyses[sms['body_md5']]
+            
             # Prepare analysis result
             analysis_result = {
                 'date': sms.get('date'),
@@ -105,28 +226,42 @@ def analyze_sms_list(sms_list: List[Dict]) -> List[Dict]:
     
     return output
 
-def ensure_keys(json_obj: Dict) -> Dict:
-    """Ensure all required keys exist with appropriate defaults."""
-    defaults = {
-        'date': None,
-        'source': '',
-        'destination': '',
-        'body': '',
-        'body_md5': '',
-        'llm_output': '',
-        'amount': 0.0,
-        'type': 'Unknown',
-        'transaction_source': '',
-        'category': 'Unknown',
-    }
-    
-    return {**defaults, **{k: v for k, v in json_obj.items() if v is not None}}
+# Output columns, in sms table / CSV order, with defaults for missing or None values
+_DEFAULTS = {
+    'date': None,
+    'source': '',
+    'destination': '',
+    'body': '',
+    'body_md5': '',
+    'llm_output': '',
+    'amount': 0.0,
+    'type': 'Unknown',
+    'transaction_source': '',
+    'category': 'Unknown',
+}
+_FIELDS = tuple(_DEFAULTS)
+_DEFAULT_ITEMS = tuple(_DEFAULTS.items())
+_BODY_MD5_INDEX = _FIELDS.index('body_md5')
+
+def row_tuple(json_obj: Dict) -> Tuple:
+    """Return the values of _FIELDS from json_obj, falling back to defaults for missing keys."""
+    return tuple(
+        default if (value := json_obj.get(key)) is None else value
+        for key, default in _DEFAULT_ITEMS
+    )
 
 def setup_database() -> sqlite3.Connection:
     """Set up SQLite database with improved schema."""
     conn = sqlite3.connect('sms.db')
     cursor = conn.cursor()
     
+    # WAL + synchronous=NORMAL avoids the double fsync per commit of the default rollback journal
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-65536')  # 64 MB
+    cursor.execute('PRAGMA mmap_size=268435456')  # 256 MB
+    
     create_table_query = '''
     CREATE TABLE IF NOT EXISTS sms (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -134,7 +269,7 @@ def setup_database() -> sqlite3.Connection:
         source TEXT,
         destination TEXT,
         body TEXT,
-        body_md5 TEXT UNIQUE,
+        body_md5 TEXT,
         llm_output TEXT,
         amount REAL,
         type TEXT,
@@ -143,9 +278,44 @@ def setup_database() -> sqlite3.Connection:
     )
     '''
     cursor.execute(create_table_query)
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS llm_cache (
+        body_md5 TEXT PRIMARY KEY,
+        llm_output TEXT,
+        json_output TEXT
+    )
+    ''')
+    
+    migrate_database(conn)
     return conn
 
-def save_to_sqlite(output: List[Dict]):
+# Bump when migrate_database gains a step; stored in PRAGMA user_version
+SCHEMA_VERSION = 1
+
+def migrate_database(conn: sqlite3.Connection):
+    """Bring databases written by older versions up to SCHEMA_VERSION."""
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return
+    
+    try:
+        if version < 1:
+            # body_md5 switched from md5 to blake2b. Rehash stored rows so the unique
+            # key still matches on re-runs; body is stored cleaned, exactly as hashed.
+            conn.create_function('body_hash', 1, body_hash, deterministic=True)
+            conn.execute('DELETE FROM sms WHERE id NOT IN (SELECT MIN(id) FROM sms GROUP BY body)')
+            conn.execute('UPDATE sms SET body_md5 = body_hash(body)')
+            # Cached analyses are keyed by the old digest and store no body to rehash
+            conn.execute('DELETE FROM llm_cache')
+        conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        conn.commit()
+    except Exception as e:
+        logger.error(f"Database migration error: {e}")
+        conn.rollback()
+        raise
+
+def save_to_sqlite(output: List[Dict], batch_size: int = 1000):
     """Save analyzed data to SQLite with improved error handling."""
     conn = setup_database()
     cursor = conn.cursor()
@@ -157,15 +327,27 @@ def save_to_sqlite(output: List[Dict]):
     ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     '''
     
+    def unique_rows():
+        # Dedupe here so a fresh table doesn't need its unique index during the load
+        seen = set()
+        for row in map(row_tuple, output):
+            body_md5 = row[_BODY_MD5_INDEX]
+            if body_md5 not in seen:
+                seen.add(body_md5)
+                yield row
+    
+    rows = unique_rows()
+    
     try:
-        for sms in output:
-            sms = ensure_keys(sms)
-            cursor.execute(insert_query, (
-                sms['date'], sms['source'], sms['destination'],
-                sms['body'], sms['body_md5'], sms['llm_output'],
-                sms['amount'], sms['type'], sms['transaction_source'],
-                sms['category']
-            ))
+        # Single transaction; rows are inserted in batches to bound memory use
+        conn.execute('BEGIN')
+        while batch := list(islice(rows, batch_size)):
+            cursor.executemany(insert_query, batch)
+        
+        # Build the unique index once after the bulk load. Older databases already
+        # have an inline UNIQUE constraint on body_md5, so skip it there.
+        if not any(index[2] for index in cursor.execute('PRAGMA index_list(sms)')):
+            cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_body_md5 ON sms(body_md5)')
         conn.commit()
     except Exception as e:
         logger.error(f"Database error: {e}")
@@ -176,18 +358,11 @@ def save_to_sqlite(output: List[Dict]):
 
 def save_to_csv(output: List[Dict], filename: str = 'sms.csv'):
     """Save analyzed data to CSV with improved field handling."""
-    fieldnames = [
-        'date', 'source', 'destination', 'body', 'body_md5',
-        'llm_output', 'amount', 'type', 'transaction_source',
-        'category'
-    ]
-    
     try:
-        with open(filename, 'w', newline='', encoding='utf-8') as file:
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-            writer.writeheader()
-            for sms in output:
-                writer.writerow(ensure_keys(sms))
+        with open(filename, 'w', newline='', encoding='utf-8', buffering=1 << 20) as file:
+            writer = csv.writer(file)
+            writer.writerow(_FIELDS)
+            writer.writerows(map(row_tuple, output))
     except Exception as e:
         logger.error(f"CSV write error: {e}")
         raise
@@ -195,16 +370,30 @@ def save_to_csv(output: List[Dict], filename: str = 'sms.csv'):
 @app.command()
 def main(
     xml_file: str = typer.Option(..., help="Path to the XML file containing SMS data"),
-    n: Optional[int] = typer.Option(None, help="Number of SMS to analyze (optional)")
+    n: Optional[int] = typer.Option(None, help="Number of SMS to analyze (optional)"),
+    concurrency: int = typer.Option(8, help="Maximum number of concurrent LLM requests (match OLLAMA_NUM_PARALLEL)"),
+    batch_size: int = typer.Option(8, help="Number of SMS sent to the LLM in a single prompt"),
+    workers: int = typer.Option(1, help="Processes used to preprocess SMS before analysis (1 = no pool)")
 ):
     """Process SMS data from XML file and store results."""
     try:
-        sms_list = parse_sms_xml(xml_file)
-        logger.info(f"Parsed {len(sms_list)} SMS messages from {xml_file}")
+        sms_list = parse_sms_xml(xml_file, workers)
         
         # Process all messages if n is None, otherwise process n messages
-        messages_to_process = sms_list[:n] if n is not None else sms_list
-        output = analyze_sms_list(messages_to_process)
+        messages_to_process = islice(sms_list, n)
+        conn = setup_database()
+        try:
+            output = asyncio.run(analyze_sms_list_async(messages_to_process, concurrency, conn, batch_size))
+        finally:
+            conn.close()
+        
+        template_hits = template_stats['template']
+        template_total = template_hits + template_stats['llm']
+        if template_total:
+            logger.info(
+                f"Template fast-path matched {template_hits}/{template_total} "
+                f"messages ({template_hits / template_total:.1%})"
+            )
         
         save_to_sqlite(output)
         save_to_csv(output)
@@ -1,7 +1,15 @@
-import json
+import asyncio
 import re
-from typing import Tuple, Optional, Dict, Any
+from collections import Counter
+from contextlib import nullcontext
+from typing import Callable, List, Tuple, Optional, Dict, Any
 import ollama
+import orjson
+
+# Shared async client so concurrent requests reuse one connection pool
+client = ollama.AsyncClient()
+
+MODEL = 'llama3.3:latest'
 
 system_prompt = """
 Analyze the following expense text and output ONLY a JSON object with these fields:
@@ -27,7 +35,73 @@ Requirements:
 11. If the money is credited/refunded, then return "Money credited/refunded" (not expense)
 """
 
-def analyze_sms(sms: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+batch_system_prompt = """
+Analyze each of the numbered expense texts below and output ONLY a JSON array with one object per message:
+Output: [
+    {
+        "Message": int, # Number of the message this object describes
+        "Amount": float,  # Amount in INR (numeric only, no currency symbols)
+        "Type": string, # Must be one of: ["Debit", "Credit"]
+        "Source": string, # Account/card number
+        "Destination": string, # Recipient
+        "Category": string # Must be one of: ["House Rent/EMI","Utility Bills","Groceries and Household Items","Transportation","Healthcare","Education Expenses","Mobile and Internet Bills","Personal Care and Clothing","Entertainment and Recreation","Savings and Investments"]
+    }
+]
+
+Requirements:
+1. Return ONLY the JSON array, no additional text
+2. Return exactly one object for every message, including its "Message" number; if the expense type is unclear, set "Category" to null
+3. Amount should be numeric only (no "Rs" or other symbols)
+4. Format numbers as floats (e.g., 480.0 not "480")
+5. If the message is not an expense, return {"Message": <number>, "NotExpense": "Not expense"}
+6. If the amount is not clear, return {"Message": <number>, "NotExpense": "Amount not clear"}
+7. Don't return any python code or other text
+8. If the message is reminder for bill payment, return {"Message": <number>, "NotExpense": "Bill payment reminder"}
+9. If the message is receipt of payment of credit card bill, return {"Message": <number>, "NotExpense": "Credit card bill payment receipt"}
+10. If money is requested, then return {"Message": <number>, "NotExpense": "Money requested"}
+11. If the money is credited/refunded, then return {"Message": <number>, "NotExpense": "Money credited/refunded"}
+"""
+
+def _amount(text: str) -> float:
+    """Convert an amount like '1,234.50' to float."""
+    return float(text.replace(',', ''))
+
+# Known bank/biller SMS formats that can be parsed without the LLM. A template
+# must produce the full result the LLM would, including Category; formats where
+# the category depends on the merchant (e.g. SBI UPI debits) are left to the LLM.
+TEMPLATES: List[Tuple[re.Pattern, Callable[[re.Match], Dict[str, Any]]]] = [
+    # Airtel broadband/mobile bill payment
+    (
+        re.compile(r'bill payment of Rs\.? ?(\d[\d,]*(?:\.\d+)?) paid via \w+ towards your (Airtel [\w ]+?) (?:ID|number|no)\b'),
+        lambda m: {
+            'Amount': _amount(m.group(1)),
+            'Type': 'Debit',
+            # The SMS names only the payment method, not an account/card number
+            'Source': None,
+            'Destination': m.group(2),
+            'Category': 'Mobile and Internet Bills',
+        },
+    ),
+]
+
+# Number of analyze_sms calls resolved by a template vs sent to the LLM
+template_stats: Counter = Counter()
+
+def try_template(sms: str) -> Optional[Dict[str, Any]]:
+    """Parse SMS with the first matching entry in TEMPLATES, or return None."""
+    for pattern, build in TEMPLATES:
+        match = pattern.search(sms)
+        if match:
+            try:
+                json_obj = build(match)
+            except Exception:
+                # A template that can't build its result counts as no match; the LLM handles it
+                return None
+            # Partial results would be cached as final, so only accept categorized ones
+            return json_obj if json_obj.get('Category') else None
+    return None
+
+async def analyze_sms(sms: str) -> Tuple[str, Optional[Dict[str, Any]]]:
     """
     Analyze SMS text using Ollama to extract expense information.
     
@@ -37,38 +111,112 @@ def analyze_sms(sms: str) -> Tuple[str, Optional[Dict[str, Any]]]:
     Returns:
         Tuple containing (raw_llm_output, parsed_json_object)
     """
+    # Known formats skip the LLM entirely
+    json_obj = try_template(sms)
+    if json_obj is not None:
+        template_stats['template'] += 1
+        return orjson.dumps(json_obj).decode(), json_obj
+    template_stats['llm'] += 1
+    
     try:
         # Generate response using Ollama
-        response = ollama.generate(
-            model='llama3.3:latest',
+        response = await client.generate(
+            model=MODEL,
             prompt=f"{system_prompt}\n\nHere is the text to analyze:\n{sms}",
         )
         
         # Extract content from response
         content = response['response']
         
-        # Search for JSON object in the response
-        json_obj = re.search(r'\{.*\}', content)
-        
-        if json_obj:
-            try:
-                return content, json.loads(json_obj.group(0))
-            except json.JSONDecodeError:
-                try:
-                    return content, json.loads(content)
-                except json.JSONDecodeError:
-                    return content, None
-        else:
-            try:
-                return content, json.loads(content)
-            except Exception as e:
-                print(f"Error during generation: {str(e)}")
-                return content, {}
+        # Take the outermost {...} span; works across newlines without regex backtracking
+        start, end = content.find('{'), content.rfind('}')
+        if start == -1 or end < start:
+            # No object at all, e.g. "Not expense"
+            return content, {}
+        try:
+            return content, orjson.loads(content[start:end + 1])
+        except orjson.JSONDecodeError:
+            return content, None
             
     except Exception as e:
         print(f"Error during generation: {str(e)}")
         return "", None
 
+async def analyze_sms_batch(
+    smses: List[str],
+    semaphore: Optional[asyncio.Semaphore] = None
+) -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+    """
+    Analyze several SMS texts with a single Ollama request.
+    
+    Messages matching a template are resolved locally; the rest are sent as one
+    numbered prompt. Any message whose number is missing from the model's array
+    is analyzed on its own instead.
+    
+    Args:
+        smses: The SMS texts to analyze
+        semaphore: If given, held for every Ollama request this batch makes
+        
+    Returns:
+        List of (raw_llm_output, parsed_json_object) tuples, in input order
+    """
+    results: List[Optional[Tuple[str, Optional[Dict[str, Any]]]]] = [None] * len(smses)
+    llm_indices = []
+    for i, sms in enumerate(smses):
+        json_obj = try_template(sms)
+        if json_obj is not None:
+            template_stats['template'] += 1
+            results[i] = (orjson.dumps(json_obj).decode(), json_obj)
+        else:
+            llm_indices.append(i)
+    
+    limit = semaphore if semaphore is not None else nullcontext()
+
+    async def analyze_limited(sms: str) -> Tuple[str, Optional[Dict[str, Any]]]:
+        async with limit:
+            return await analyze_sms(sms)
+    
+    if len(llm_indices) == 1:
+        results[llm_indices[0]] = await analyze_limited(smses[llm_indices[0]])
+    elif llm_indices:
+        numbered = '\n'.join(f"{n}. {smses[i]}" for n, i in enumerate(llm_indices, 1))
+        items = None
+        try:
+            async with limit:
+                response = await client.generate(
+                    model=MODEL,
+                    prompt=(
+                        f"{batch_system_prompt}\n\nAnalyze each of the following {len(llm_indices)} messages "
+                        f"and return a JSON array of {len(llm_indices)} entries:\n{numbered}"
+                    ),
+                )
+            content = response['response']
+            start, end = content.find('['), content.rfind(']')
+            if start != -1 and end > start:
+                items = orjson.loads(content[start:end + 1])
+        except Exception as e:
+            print(f"Error during batch generation: {str(e)}")
+        
+        # Match entries by their "Message" number, never by array position
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict):
+                continue
+            number = item.pop('Message', None)
+            if isinstance(number, int) and 1 <= number <= len(llm_indices):
+                i = llm_indices[number - 1]
+                if results[i] is None:
+                    template_stats['llm'] += 1
+                    # Non-expense entries map to {}, same as analyze_sms
+                    results[i] = (content, {} if 'NotExpense' in item else item)
+        
+        # Messages the model skipped or misnumbered are analyzed on their own
+        missing = [i for i in llm_indices if results[i] is None]
+        fallback = await asyncio.gather(*(analyze_limited(smses[i]) for i in missing))
+        for i, result in zip(missing, fallback):
+            results[i] = result
+    
+    return results
+
 # Sample SMS messages
 smses = [
     'Dear SBI User, your A/c X2684-debited by Rs480.0 on 19Dec22 transfer to tpslQR Ref No 235371592525. If not done by u, fwd this SMS to 9223008333/Call 1800111109 or 09449112211 to block UPI -SBI',
@@ -77,16 +225,19 @@ smses = [
     'We are committed to make your experience beautiful with Airtel. For any assistance, please contact our team of expert advisors by dialing 198/121 from your Airtel number. In case if you are not satisfied with the resolution provided by the call centre, you can contact the Appellate authority on the same number.'
 ]
 
-if __name__ == "__main__":
+async def main():
     for sms in smses:
         print('=' * 100)
         print('SMS:')
         print(sms)
         print('-' * 100)
         print('LLM Output:')
-        content, json_obj = analyze_sms(sms)
+        content, json_obj = await analyze_sms(sms)
         print(content)
         print('-' * 100)
         print('JSON Output:')
         print(json_obj)
-        print('=' * 100)
\ No newline at end of file
+        print('=' * 100)
+
+if __name__ == "__main__":
+    asyncio.run(main())
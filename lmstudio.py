@@ -1,8 +1,8 @@
 # Example: reuse your existing OpenAI setup
 from openai import OpenAI
-import re
 import json
-# Point to the local server
+# Point to the local server; one client for the whole run keeps its HTTP connections alive
+client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
 
 # breakpoint()
 
@@ -39,7 +39,6 @@ smses = ['Dear SBI User, your A/c X2684-debited by Rs480.0 on 19Dec22 transfer t
 
 def analyze_sms(sms):
     user_prompt = sms
-    client = OpenAI(base_url="http://localhost:1234/v1", api_key="lm-studio")
     completion = client.chat.completions.create(
         model="lmstudio-community/Meta-Llama-3-8B-Instruct-GGUF",
         messages=[
@@ -49,18 +48,13 @@ def analyze_sms(sms):
         temperature=0.8,
     )
     content = completion.choices[0].message.content
-    # search for the json object
-    json_obj = re.search(r'\{.*\}', content)
-    del completion, client
-    if json_obj:
-        try:
-            return content, json.loads(json_obj.group(0))
-        except json.JSONDecodeError:
-            try:
-                return content, json.loads(content)
-            except json.JSONDecodeError:
-                return content, None
-    else:
+    # take the outermost {...} span, which also works across newlines
+    start, end = content.find('{'), content.rfind('}')
+    if start == -1 or end < start:
+        return content, None
+    try:
+        return content, json.loads(content[start:end + 1])
+    except json.JSONDecodeError:
         return content, None
     
 